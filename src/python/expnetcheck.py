@@ -0,0 +1,73 @@
+''' Integrity checker for network graph files.
+
+    Validates every graph file in the given files and directories using a pool of processes,
+    reporting dangling links, duplicate names and invalid colours or shapes.
+    With --repair the problems are fixed and the original file is kept with a .bak extension.
+
+    python src/python/expnetcheck.py runs/ --repair
+'''
+import os
+import shutil
+from glob import glob
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import expnetgraph
+
+
+def find_files(paths, pattern: str):
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob(os.path.join(path, '**', pattern), recursive=True)))
+        else:
+            files.append(path)
+    return files
+
+
+def check_file(path: str, repair: bool=False):
+    ''' Validate a single file. Returns the path, the problems found and an error message if the file could not be read '''
+    try:
+        with open(path, encoding='utf-8') as f:
+            netgraph = expnetgraph.load_network_graph_from_json(f.read())
+        problems = expnetgraph.validate_network_graph(netgraph, repair=repair)
+    except Exception as e:
+        return path, [], f"{type(e).__name__}: {e}"
+
+    if repair and problems:
+        shutil.copyfile(path, path + '.bak')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(expnetgraph.save_network_graph_to_json(netgraph))
+    return path, problems, None
+
+
+def main():
+    parser = ArgumentParser("Network graph file integrity checker")
+    parser.add_argument('paths', nargs='+', help="Graph files or directories to search for graph files")
+    parser.add_argument('--pattern', type=str, default='*.pjson', help="File pattern used when searching directories")
+    parser.add_argument('--repair', default=False, action='store_true', help="Fix problems, keeping the original as a .bak file")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="Number of processes. Defaults to the number of CPUs")
+    args = parser.parse_args()
+
+    files = find_files(args.paths, args.pattern)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        chunksize = max(1, len(files) // (4 * (args.jobs or os.cpu_count() or 1)))
+        for path, problems, error in pool.map(check_file, files, [args.repair] * len(files), chunksize=chunksize):
+            if error:
+                failed += 1
+                print(f"{path}: unreadable: {error}")
+            elif problems:
+                if not args.repair:
+                    failed += 1
+                print(f"{path}: {len(problems)} problems{' repaired' if args.repair else ''}")
+                for problem in problems:
+                    print(f"  {problem}")
+
+    print(f"Checked {len(files)} files, {failed} with unresolved problems")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    raise SystemExit(main())
\ No newline at end of file
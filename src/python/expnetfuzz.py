@@ -0,0 +1,489 @@
+''' Model-based correctness harness for NetworkGraph.
+
+    Applies random sequences of graph operations, merges, undo/redo, save/load round trips and document
+    switches to a NetworkGraph and a simple reference model, checking after every step that both agree,
+    that the graph's internal structures are consistent and that caches kept up to date by change events
+    are correct. Copies of the graph are also corrupted to check that validation repairs them.
+
+    python src/python/expnetfuzz.py --runs 50 --ops 1000 --names 200
+'''
+import os
+import copy
+import random
+import tempfile
+from typing import List
+from argparse import ArgumentParser
+import expnetgraph
+
+
+NAMES = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta', 'iota', 'kappa', 'lambda', 'mu', 'straße', 'strasse']
+HISTORY_LIMIT = 8 # Small so the history files are compacted often
+WORDS = ['boss', 'fog', 'gate', 'lift', 'key', 'ladder', 'bonfire', 'grace', 'river', 'tower']
+
+
+def check(condition, msg: str):
+    if not condition:
+        raise AssertionError(msg)
+
+
+def push_bounded(stack: list, item):
+    ''' Mirror of the undo history on disk, which drops the oldest entries once it grows a quarter past the limit '''
+    stack.append(item)
+    if len(stack) >= HISTORY_LIMIT + max(1, HISTORY_LIMIT // 4):
+        del stack[:len(stack) - HISTORY_LIMIT]
+
+
+
+class ReferenceModel():
+    ''' Straightforward model of a network graph. Nodes are keyed by caseless name and links by a sorted pair of caseless names '''
+    def __init__(self):
+        self.nodes = dict() # key -> [name, colour, shape, notes]
+        self.links = dict() # (key, key) -> msg
+
+
+    @staticmethod
+    def link_key(a: str, b: str):
+        return tuple(sorted((expnetgraph.name_key(a), expnetgraph.name_key(b))))
+
+
+    def has_node(self, name: str) -> bool:
+        return expnetgraph.name_key(name) in self.nodes
+
+
+    def rename_node(self, old_name: str, new_name: str):
+        old_key = expnetgraph.name_key(old_name)
+        new_key = expnetgraph.name_key(new_name)
+        self.nodes[new_key] = self.nodes.pop(old_key)
+        self.nodes[new_key][0] = new_name
+        self.links = { self.link_key(*(new_key if k == old_key else k for k in key)): msg for key, msg in self.links.items() }
+
+
+    def delete_node(self, name: str):
+        key = expnetgraph.name_key(name)
+        self.nodes.pop(key)
+        self.links = { k: msg for k, msg in self.links.items() if not key in k }
+
+
+
+def graph_state(graph: expnetgraph.NetworkGraph):
+    ''' Extract the same representation as ReferenceModel from a graph '''
+    nodes = { expnetgraph.name_key(n.name): [n.name, n.colour, n.shape, n.notes] for n in graph._nodes.values() }
+    links = dict()
+    for n in graph._nodes.values():
+        for e in n.links:
+            key = ReferenceModel.link_key(n.name, graph.get_node_by_id(e._to).name)
+            check(not key in links, f"Duplicate link between {key}")
+            links[key] = e.msg
+    return nodes, links
+
+
+def check_invariants(graph: expnetgraph.NetworkGraph):
+    check(len(graph._nodes) == len(graph._names_map), "Names map and nodes differ in size")
+    for name, id in graph._names_map.items():
+        check(id in graph._nodes, f"Names map refers to missing node id: {id}")
+        check(graph._nodes[id].name == name, f"Names map entry '{name}' refers to node '{graph._nodes[id].name}'")
+    check(len({ expnetgraph.name_key(n) for n in graph._names_map }) == len(graph._names_map), "Duplicate node names")
+    for n in graph._nodes.values():
+        check(n.id in graph._nodes and graph._nodes[n.id] is n, f"Node stored under wrong id: {n.name}")
+        check(n.is_valid(), f"Node is not valid: {n}")
+        for e in n.links:
+            check(e._to in graph._nodes, f"Dangling link from '{n.name}' to id {e._to}")
+
+
+def check_matches(graph: expnetgraph.NetworkGraph, model: ReferenceModel):
+    check_invariants(graph)
+    nodes, links = graph_state(graph)
+    check(nodes == model.nodes, f"Nodes differ from model.\ngraph: {nodes}\nmodel: {model.nodes}")
+    check(links == model.links, f"Links differ from model.\ngraph: {links}\nmodel: {model.links}")
+
+
+def check_node_names(graph: expnetgraph.NetworkGraph, node_names: List[str]):
+    check(sorted(node_names) == sorted(graph.get_all_node_names()), "Node names from change events are out of date")
+
+
+def check_text_index(graph: expnetgraph.NetworkGraph, text_index: expnetgraph.TextIndex):
+    ''' The incrementally maintained index must equal one built from scratch '''
+    rebuilt = expnetgraph.TextIndex()
+    rebuilt.rebuild(graph)
+    check(text_index._node_postings == rebuilt._node_postings, "Text index node postings are out of date")
+    check(text_index._link_postings == rebuilt._link_postings, "Text index link postings are out of date")
+
+
+def check_round_trip(graph: expnetgraph.NetworkGraph) -> expnetgraph.NetworkGraph:
+    ''' Both file formats must reproduce the graph exactly, including ids '''
+    state = { n.id: (n.name, n.colour, n.shape, n.notes, [ (e._to, e.msg) for e in n.links ]) for n in graph._nodes.values() }
+    loaded = expnetgraph.load_network_graph_from_json(expnetgraph.save_network_graph_to_json(graph))
+    snapshot = expnetgraph.network_graph_from_snapshot(expnetgraph.network_graph_to_snapshot(graph))
+    for other in (loaded, snapshot):
+        check_invariants(other)
+        check(not expnetgraph.validate_network_graph(other), "Validation found problems in a consistent graph")
+        other_state = { n.id: (n.name, n.colour, n.shape, n.notes, [ (e._to, e.msg) for e in n.links ]) for n in other._nodes.values() }
+        check(other_state == state, "Graph changed after a save/load round trip")
+    return loaded
+
+
+
+class RenderedData():
+    ''' Mirror of the node and edge DataSets in the page, updated the same way as applyGraphChanges '''
+    def __init__(self):
+        self.nodes = dict()
+        self.edges = dict()
+
+
+    def load(self, data: dict):
+        self.nodes = { n['id']: n for n in data['nodes'] }
+        self.edges = { e['id']: e for e in data['edges'] }
+
+
+    def apply(self, update: dict):
+        for id in update['removeEdges']:
+            self.edges.pop(id, None)
+        for op in update['operations']:
+            if op[0] == 'rename':
+                self.rename(op[1], op[2])
+            elif op[0] == 'remove':
+                self.nodes.pop(op[1], None)
+        for n in update['nodes']:
+            self.nodes.setdefault(n['id'], dict()).update(n)
+        for e in update['edges']:
+            self.edges.setdefault(e['id'], dict()).update(e)
+
+
+    def rename(self, old_id: str, new_id: str):
+        node = self.nodes.pop(old_id, None)
+        if node is None:
+            return
+        self.nodes[new_id] = dict(node, id=new_id, label=new_id)
+        for e in self.edges.values():
+            if e['from'] == old_id:
+                e['from'] = new_id
+            if e['to'] == old_id:
+                e['to'] = new_id
+
+
+
+def check_rendered(graph: expnetgraph.NetworkGraph, rendered: RenderedData):
+    ''' Data updated from change events must equal data generated from scratch '''
+    data = expnetgraph.generate_data(graph)
+    check(rendered.nodes == { n['id']: n for n in data['nodes'] }, "Rendered nodes are out of date")
+    check(rendered.edges == { e['id']: e for e in data['edges'] }, "Rendered edges are out of date")
+    # The page data must stay the same as the pyvis network that generate builds
+    net = expnetgraph.create_network()
+    expnetgraph.populate_network(net, graph)
+    pyvis_data = expnetgraph.network_data(net)
+    check(sorted(data['nodes'], key=lambda n: n['id']) == sorted(pyvis_data['nodes'], key=lambda n: n['id']),
+          "Node data differs from pyvis")
+    check(sorted(data['edges'], key=lambda e: e['id']) == sorted(pyvis_data['edges'], key=lambda e: e['id']),
+          "Edge data differs from pyvis")
+
+
+
+class Harness():
+    ''' One random run of operations against a NetworkGraph and the reference model '''
+    def __init__(self, seed: int, names: int, directory: str):
+        self.rand = random.Random(seed)
+        self.names = [ f'{NAMES[i % len(NAMES)]}{i // len(NAMES) or ""}' for i in range(names) ]
+        self.path = os.path.join(directory, f'fuzz_{seed}.pjson')
+        self.other_path = os.path.join(directory, f'fuzz_{seed}_other.pjson')
+        self.documents = expnetgraph.DocumentManager(max_loaded=1)
+        self.document = None
+        self.graph = None
+        self.history = None
+        self.model = ReferenceModel()
+        self.text_index = expnetgraph.TextIndex()
+        self.node_names = list()
+        self.rendered = RenderedData()
+        self.open_document()
+        self.model_undos = list()
+        self.model_redos = list()
+        self.log = list()
+
+
+    def open_document(self):
+        ''' Open the save file as a document as expnetvis does, with a smaller history so it is compacted often '''
+        self.documents.close(self.path)
+        self.document = self.documents.open(self.path)
+        check(not self.document.problems, f"Validation found problems in a saved graph: {self.document.problems}")
+        self.document.history = expnetgraph.UndoHistory(self.path, memory_limit=4, max_entries=HISTORY_LIMIT)
+        self.history = self.document.history
+        self.set_graph(self.document.get_graph())
+
+
+    def set_graph(self, graph: expnetgraph.NetworkGraph):
+        if self.graph:
+            self.graph.unsubscribe(self.graph_changed)
+        self.graph = graph
+        self.graph.subscribe(self.graph_changed)
+        self.graph_changed([expnetgraph.GraphChange(expnetgraph.ChangeType.RESET)])
+
+
+    def graph_changed(self, changes: List[expnetgraph.GraphChange]):
+        ''' Maintain the same caches as expnetvis from change events '''
+        self.text_index.apply_changes(self.graph, changes)
+        for c in changes:
+            if c.type == expnetgraph.ChangeType.RESET:
+                self.node_names[:] = self.graph.get_all_node_names()
+            elif c.type == expnetgraph.ChangeType.NODE_ADDED:
+                self.node_names.append(c.name)
+            elif c.type == expnetgraph.ChangeType.NODE_REMOVED:
+                self.node_names.remove(c.name)
+            elif c.type == expnetgraph.ChangeType.NODE_RENAMED:
+                self.node_names[self.node_names.index(c.old_name)] = c.name
+        update = expnetgraph.generate_data_changes(self.graph, changes)
+        if update is None:
+            self.rendered.load(expnetgraph.generate_data(self.graph))
+        else:
+            self.rendered.apply(update)
+
+
+    def random_name(self) -> str:
+        ''' A node name in random case so the caseless lookups are exercised '''
+        name = self.rand.choice(self.names)
+        return ''.join(c.upper() if self.rand.random() < 0.3 else c for c in name)
+
+
+    def random_text(self) -> str:
+        return ' '.join(self.rand.choices(WORDS, k=self.rand.randint(0, 3)))
+
+
+    def modify(self, op, expect_error: bool, update_model):
+        ''' Mirror the netgraph_modification decorator. An undo is recorded even when the operation fails '''
+        self.history.add_undo(self.graph)
+        push_bounded(self.model_undos, copy.deepcopy(self.model))
+        try:
+            with self.graph.batch():
+                op()
+        except expnetgraph.NetGraphException:
+            check(expect_error, "Operation raised an unexpected NetGraphException")
+            return
+        check(not expect_error, "Operation succeeded but was expected to fail")
+        update_model()
+        self.history.clear_redos()
+        self.model_redos.clear()
+
+
+    def add_node(self):
+        name = self.random_name()
+        colour = self.rand.choice(expnetgraph.COLOURS + ['Beige'])
+        shape = self.rand.choice(expnetgraph.SHAPES)
+        self.log.append(f"add_node({name!r}, {colour!r}, {shape!r})")
+        def update_model():
+            self.model.nodes[expnetgraph.name_key(name)] = [name, colour, shape, ""]
+        self.modify(lambda: self.graph.add_node(expnetgraph.Node(name, colour=colour, shape=shape)),
+                    self.model.has_node(name) or not colour in expnetgraph.COLOURS, update_model)
+
+
+    def rename_node(self):
+        old_name = self.random_name()
+        new_name = self.random_name()
+        self.log.append(f"rename_node({old_name!r}, {new_name!r})")
+        exists = self.model.has_node(new_name) and expnetgraph.name_key(new_name) != expnetgraph.name_key(old_name)
+        self.modify(lambda: self.graph.rename_node(old_name, new_name),
+                    not self.model.has_node(old_name) or exists, lambda: self.model.rename_node(old_name, new_name))
+
+
+    def edit_node(self):
+        name = self.random_name()
+        colour = self.rand.choice(expnetgraph.COLOURS)
+        shape = self.rand.choice(expnetgraph.SHAPES)
+        notes = self.random_text()
+        self.log.append(f"edit_node({name!r}, {colour!r}, {shape!r}, {notes!r})")
+        def update_model():
+            self.model.nodes[expnetgraph.name_key(name)][1:] = [colour, shape, notes]
+        self.modify(lambda: self.graph.edit_node(name, colour, shape, notes), not self.model.has_node(name), update_model)
+
+
+    def add_link(self):
+        a = self.random_name()
+        b = self.random_name()
+        msg = self.random_text()
+        self.log.append(f"add_link({a!r}, {b!r}, {msg!r})")
+        def update_model():
+            self.model.links[ReferenceModel.link_key(a, b)] = msg
+        missing = not self.model.has_node(a) or not self.model.has_node(b)
+        self.modify(lambda: self.graph.add_link(a, b, msg),
+                    missing or ReferenceModel.link_key(a, b) in self.model.links, update_model)
+
+
+    def edit_link(self):
+        a = self.random_name()
+        b = self.random_name()
+        msg = self.random_text()
+        self.log.append(f"edit_link({a!r}, {b!r}, {msg!r})")
+        def update_model():
+            self.model.links[ReferenceModel.link_key(a, b)] = msg
+        missing = not self.model.has_node(a) or not self.model.has_node(b)
+        self.modify(lambda: self.graph.edit_link(a, b, msg),
+                    missing or not ReferenceModel.link_key(a, b) in self.model.links, update_model)
+
+
+    def remove_link(self):
+        a = self.random_name()
+        b = self.random_name()
+        self.log.append(f"remove_link({a!r}, {b!r})")
+        def update_model():
+            self.model.links.pop(ReferenceModel.link_key(a, b), None)
+        self.modify(lambda: self.graph.remove_link(a, b), not self.model.has_node(a) or not self.model.has_node(b), update_model)
+
+
+    def delete_node(self):
+        name = self.random_name()
+        self.log.append(f"delete_node({name!r})")
+        self.modify(lambda: self.graph.delete_node(name), not self.model.has_node(name), lambda: self.model.delete_node(name))
+
+
+    def undo(self):
+        self.log.append("undo()")
+        other = self.history.undo(self.graph)
+        check((other is None) == (not self.model_undos), "Undo history length differs from model")
+        if other:
+            self.graph.set_nodes(other)
+            push_bounded(self.model_redos, self.model)
+            self.model = self.model_undos.pop()
+
+
+    def redo(self):
+        self.log.append("redo()")
+        other = self.history.redo(self.graph)
+        check((other is None) == (not self.model_redos), "Redo history length differs from model")
+        if other:
+            self.graph.set_nodes(other)
+            push_bounded(self.model_undos, self.model)
+            self.model = self.model_redos.pop()
+
+
+    def reload(self):
+        ''' Save and load the graph as the application does when switching documents or restarting '''
+        self.log.append("reload()")
+        expnetgraph.save_network_graph(self.path, self.graph)
+        self.history.saved()
+        if self.history.undos and self.rand.random() < 0.5:
+            # A write torn by a crash must only lose the partial record
+            with open(self.path + '.undo', 'ab') as f:
+                f.write(bytes(self.rand.randint(1, 40)))
+        self.open_document()
+        check(len(self.history.undos) == len(self.model_undos), "Undo history length changed on reload")
+        check(len(self.history.redos) == len(self.model_redos), "Redo history length changed on reload")
+
+
+    def merge(self):
+        ''' Merge a random graph built from the same name pool '''
+        other = expnetgraph.NetworkGraph()
+        for _ in range(self.rand.randint(0, 6)):
+            node = expnetgraph.Node(self.random_name(), colour=self.rand.choice(expnetgraph.COLOURS),
+                                    shape=self.rand.choice(expnetgraph.SHAPES), notes=self.random_text())
+            if not other.contains_node(node.name):
+                other.add_node(node)
+        names = other.get_all_node_names()
+        for _ in range(self.rand.randint(0, 6) if names else 0):
+            try:
+                other.add_link(self.rand.choice(names), self.rand.choice(names), self.random_text())
+            except expnetgraph.NetGraphException:
+                pass
+        other_nodes, other_links = graph_state(other)
+        self.log.append(f"merge({other_nodes!r}, {other_links!r})")
+
+        def update_model():
+            # Added nodes and links are merged, empty notes and messages are filled in and conflicts are skipped
+            for key, node in other_nodes.items():
+                base = self.model.nodes.get(key)
+                if base is None:
+                    self.model.nodes[key] = list(node)
+                elif not base[3]:
+                    base[3] = node[3]
+            for key, msg in other_links.items():
+                if not self.model.links.get(key):
+                    self.model.links[key] = msg
+        self.modify(lambda: expnetgraph.merge_network_graphs(self.graph, other), False, update_model)
+
+
+    def switch_document(self):
+        ''' Switch to another document and back, so the working graph is evicted to a snapshot and reloaded '''
+        self.log.append("switch_document()")
+        self.documents.open(self.other_path)
+        check(not self.document.is_loaded(), "Inactive document was not evicted")
+        self.documents.activate(self.path)
+        self.set_graph(self.document.get_graph())
+
+
+    def repair_corrupted(self):
+        ''' Corrupt a copy of the graph and check that validation repairs it into a consistent graph '''
+        corrupted = expnetgraph.network_graph_from_snapshot(expnetgraph.network_graph_to_snapshot(self.graph))
+        nodes = list(corrupted._nodes.values())
+        if not nodes:
+            return
+        node = self.rand.choice(nodes)
+        kind = self.rand.choice([ 'missing_field', 'colour', 'shape', 'duplicate_name', 'dangling_link', 'link_msg', 'wrong_key' ])
+        self.log.append(f"repair_corrupted({kind!r}, {node.name!r})")
+        if kind == 'missing_field':
+            delattr(node, self.rand.choice([ 'id', 'name', 'colour', 'shape', 'notes', 'links' ]))
+        elif kind == 'colour':
+            node.colour = self.rand.choice([ None, 'Beige', node.colour.upper() ])
+        elif kind == 'shape':
+            node.shape = self.rand.choice([ None, 'hexagon', 5 ])
+        elif kind == 'duplicate_name':
+            node.name = self.rand.choice(nodes).name.upper()
+            if node.name in corrupted._names_map:
+                return # Renamed to its own name
+        elif kind == 'dangling_link':
+            node.links.append(expnetgraph.Link('missing'))
+        elif kind == 'link_msg':
+            if not node.links:
+                return
+            node.links[0].msg = None
+        elif kind == 'wrong_key':
+            corrupted._nodes['wrong'] = corrupted._nodes.pop(node.id)
+
+        check(expnetgraph.validate_network_graph(corrupted, repair=True), "Validation missed a corruption")
+        check_invariants(corrupted)
+        check(not expnetgraph.validate_network_graph(corrupted), "Repaired graph still has problems")
+
+
+    def round_trip(self):
+        self.log.append("round_trip()")
+        self.graph.set_nodes(check_round_trip(self.graph)) # The document must keep owning the working graph
+
+
+    def run(self, ops: int):
+        operations = [ (self.add_node, 6), (self.rename_node, 2), (self.edit_node, 2), (self.add_link, 6),
+                       (self.edit_link, 2), (self.remove_link, 2), (self.delete_node, 2),
+                       (self.undo, 2), (self.redo, 1), (self.round_trip, 1), (self.merge, 1),
+                       (self.switch_document, 1), (self.repair_corrupted, 1) ]
+        funcs = [ x[0] for x in operations ]
+        weights = [ x[1] for x in operations ]
+        for i in range(ops):
+            if i and i % 100 == 0:
+                self.reload()
+            self.rand.choices(funcs, weights)[0]()
+            check_matches(self.graph, self.model)
+            check_text_index(self.graph, self.text_index)
+            check_node_names(self.graph, self.node_names)
+            check_rendered(self.graph, self.rendered)
+
+
+
+def main():
+    parser = ArgumentParser("NetworkGraph model-based correctness harness")
+    parser.add_argument('--runs', type=int, default=20, help="Number of random runs")
+    parser.add_argument('--ops', type=int, default=500, help="Operations per run")
+    parser.add_argument('--names', type=int, default=40, help="Size of the node name pool. Larger pools give larger graphs")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the first run. Each run uses the next seed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seed, args.seed + args.runs):
+            harness = Harness(seed, args.names, directory)
+            try:
+                harness.run(args.ops)
+            except Exception:
+                print(f"Run with seed {seed} failed after:")
+                for line in harness.log[-20:]:
+                    print("  " + line)
+                raise
+            finally:
+                harness.documents.cleanup()
+            print(f"Seed {seed}: {args.ops} operations OK, final graph has {len(harness.graph._nodes)} nodes")
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -1,13 +1,32 @@
 from __future__ import annotations
-from typing import List
+from typing import Callable, List, Dict, Set, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from enum import Enum
+from weakref import WeakKeyDictionary
 from pyvis.network import Network
 from uuid import uuid4
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import json
+import gzip
+import zlib
+import struct
 import jsonpickle
 
+FONT_COLOUR = 'white'
 COLOURS = ['White', 'Pink', 'Red', 'Maroon', 'Yellow', 'Green', 'Lime', 'Green', 'Olive', 'Aqua', 'Blue', 'Navy', 'Fuchsia', 'Purple', 'Teal', 'Silver', 'Gold']
 SHAPES = ['dot', 'circle', 'ellipse', 'triangle', 'triangleDown', 'square', 'box', 'diamond', 'star', 'database']
 
 
+def name_key(name: str) -> str:
+    ''' Node names are unique ignoring case. Every caseless comparison of names must use this key '''
+    return name.lower()
+
+
 class NetGraphException(Exception):
     def __init__(self, msg: str) -> None:
         super().__init__(msg)
@@ -66,6 +85,45 @@ class Node():
 
 
 
+class ChangeType(Enum):
+    NODE_ADDED = 'node_added'
+    NODE_REMOVED = 'node_removed'
+    NODE_RENAMED = 'node_renamed'
+    NODE_EDITED = 'node_edited'    # Colour, shape or notes changed
+    LINK_ADDED = 'link_added'
+    LINK_REMOVED = 'link_removed'
+    LINK_EDITED = 'link_edited'
+    RESET = 'reset'                # Every node was replaced
+
+
+class GraphChange():
+    ''' A change made to a NetworkGraph.
+        Node changes have the node's id and name at the time of the change.
+        Link changes have the id of the node holding the link and the id it links to.
+    '''
+    def __init__(self, type: ChangeType, node_id: str=None, other_id: str=None, name: str=None, old_name: str=None):
+        self.type = type
+        self.node_id = node_id
+        self.other_id = other_id
+        self.name = name
+        self.old_name = old_name
+
+    def __str__(self) -> str:
+        return str(self.__dict__)
+
+
+class _GraphObservers():
+    def __init__(self):
+        self.subscribers = list()
+        self.batch_depth = 0
+        self.pending = list()
+
+
+## Kept outside of NetworkGraph so subscribers are never pickled into save files
+_graph_observers = WeakKeyDictionary()
+
+
+
 class NetworkGraph():
     def __init__(self, nodes: List[Node]=[]):
         self._nodes = { n.id: n for n in nodes }
@@ -77,6 +135,52 @@ class NetworkGraph():
 
         self._nodes.update(netgraph._nodes)
         self._names_map.update(netgraph._names_map)
+        self._emit(GraphChange(ChangeType.RESET))
+
+
+    def subscribe(self, callback: Callable[[List[GraphChange]], None]):
+        ''' Call back with a list of changes after every modification, or once at the end of a batch '''
+        observers = _graph_observers.setdefault(self, _GraphObservers())
+        if not callback in observers.subscribers:
+            observers.subscribers.append(callback)
+
+
+    def unsubscribe(self, callback: Callable[[List[GraphChange]], None]):
+        observers = _graph_observers.get(self)
+        if observers and callback in observers.subscribers:
+            observers.subscribers.remove(callback)
+
+
+    @contextmanager
+    def batch(self):
+        ''' Deliver every change made within this context to subscribers as a single list '''
+        observers = _graph_observers.setdefault(self, _GraphObservers())
+        observers.batch_depth += 1
+        try:
+            yield self
+        finally:
+            observers.batch_depth -= 1
+            if observers.batch_depth == 0:
+                self.__notify(observers)
+
+
+    def _emit(self, change: GraphChange):
+        observers = _graph_observers.get(self)
+        if observers is None or not observers.subscribers:
+            return
+        observers.pending.append(change)
+        if observers.batch_depth == 0:
+            self.__notify(observers)
+
+
+    @staticmethod
+    def __notify(observers: _GraphObservers):
+        if not observers.pending:
+            return
+        changes = observers.pending
+        observers.pending = list()
+        for callback in list(observers.subscribers):
+            callback(changes)
 
 
     def get_all_node_names(self) -> List[str]:
@@ -97,9 +201,9 @@ class NetworkGraph():
     
 
     def __get_node_lower(self, name: str) -> Node:
-        name_lower = name.lower()
+        key = name_key(name)
         for k in self._names_map.keys():
-            if k.lower() == name_lower:
+            if name_key(k) == key:
                 id = self._names_map[k]
                 return self.get_node_by_id(id)
         raise NetGraphException("Node does not exist: " + name)
@@ -120,13 +224,28 @@ class NetworkGraph():
             raise NetGraphException("Node already exists: " + node.name)
         self._nodes[node.id] = node
         self._names_map[node.name] = node.id
+        self._emit(GraphChange(ChangeType.NODE_ADDED, node.id, name=node.name))
 
 
     def rename_node(self, old_name, new_name):
         node = self.get_node(old_name)
-        node.name = new_name
+        if self.contains_node(new_name) and self.get_node(new_name) is not node:
+            raise NetGraphException("Node already exists: " + new_name)
+        old_name = node.name # May differ in case from the given name
         self._names_map.pop(old_name)
+        node.name = new_name
         self._names_map[new_name] = node.id
+        self._emit(GraphChange(ChangeType.NODE_RENAMED, node.id, name=new_name, old_name=old_name))
+
+
+    def edit_node(self, name: str, colour: str, shape: str, notes: str):
+        if not colour in COLOURS or not shape in SHAPES:
+            raise NetGraphException(f"Invalid colour or shape: {colour}, {shape}")
+        node = self.get_node(name)
+        node.colour = colour
+        node.shape = shape
+        node.notes = notes
+        self._emit(GraphChange(ChangeType.NODE_EDITED, node.id, name=node.name))
 
 
     def get_link(self, nodeA: str, nodeB: str, throw_not_found=True):
@@ -150,18 +269,27 @@ class NetworkGraph():
             raise(NetGraphException(f"A link between '{from_node}' and '{to_node}' already exists"))
 
         node.add_link(Link(other_node.id, msg))
+        self._emit(GraphChange(ChangeType.LINK_ADDED, node.id, other_node.id))
 
     
     def remove_link(self, nodeA: str, nodeB: str):
         a = self.get_node(nodeA)
         b = self.get_node(nodeB)
-        a.remove_link(b.id)
-        b.remove_link(a.id)
+        for x, y in ((a, b), (b, a)):
+            if x.get_link(y.id):
+                x.remove_link(y.id)
+                self._emit(GraphChange(ChangeType.LINK_REMOVED, x.id, y.id))
 
 
     def edit_link(self, nodeA: str, nodeB: str, msg: str):
         link = self.get_link(nodeA, nodeB)
         link.msg = msg
+        a = self.get_node(nodeA)
+        b = self.get_node(nodeB)
+        if a.get_link(b.id) is link:
+            self._emit(GraphChange(ChangeType.LINK_EDITED, a.id, b.id))
+        else:
+            self._emit(GraphChange(ChangeType.LINK_EDITED, b.id, a.id))
 
 
     def delete_node(self, name: str):
@@ -173,32 +301,341 @@ class NetworkGraph():
         
         ## Delete links from other nodes
         for n in self._nodes.values():
-            n.remove_link(node.id)
+            if n.get_link(node.id):
+                n.remove_link(node.id)
+                self._emit(GraphChange(ChangeType.LINK_REMOVED, n.id, node.id))
+        for e in node.links:
+            self._emit(GraphChange(ChangeType.LINK_REMOVED, node.id, e._to))
+        self._emit(GraphChange(ChangeType.NODE_REMOVED, node.id, name=node.name))
 
 
 
-def generate_custom(net: Network, graph: NetworkGraph) -> str:
-    ''' Generate HTML to display the network graph '''
+def populate_network(net: Network, graph: NetworkGraph):
+    ''' Add the nodes and links of the network graph to a pyvis network '''
     for n in graph._nodes.values():
-        net.add_node(n.name, label=n.name, title=f'{n.name}\n{n.notes}', color=n.colour, shape=n.shape)
+        data = node_data(n)
+        net.add_node(data.pop('id'), **data)
     
     for n in graph._nodes.values():
         for e in n.links:
-            to_node = graph.get_node_by_id(e._to)
-            net.add_edge(n.name, to_node.name, title=e.msg)
-    
+            data = link_data(n, graph.get_node_by_id(e._to), e)
+            net.add_edge(data.pop('from'), data.pop('to'), **data)
+
+
+def generate_custom(net: Network, graph: NetworkGraph) -> str:
+    ''' Generate HTML to display the network graph '''
+    populate_network(net, graph)
     return net.generate_html()
 
 
 
-def generate(graph: NetworkGraph) -> str:
-    ''' Generate HTML to display the network graph '''
-    net = Network(height="90vh", width="100%", bgcolor="#222222", font_color="white",
+def create_network() -> Network:
+    net = Network(height="90vh", width="100%", bgcolor="#222222", font_color=FONT_COLOUR,
                   select_menu=True, filter_menu=False)
     net.toggle_physics(True)
     #net.show_buttons()
+    return net
+
+
+
+def generate(graph: NetworkGraph) -> str:
+    ''' Generate HTML to display the network graph '''
+    return generate_custom(create_network(), graph)
+
+
+def network_data(net: Network) -> Dict:
+    ''' The vis.js node and edge data of a pyvis network '''
+    nodes, edges, *_ = net.get_network_data()
+    return { 'nodes': nodes, 'edges': edges }
+
+
+def node_data(node: Node) -> Dict:
+    ''' The vis.js data of a node. populate_network adds the same data through pyvis '''
+    return { 'color': node.colour, 'title': f'{node.name}\n{node.notes}', 'id': node.name, 'label': node.name,
+             'shape': node.shape, 'font': { 'color': FONT_COLOUR } }
+
+
+def link_data_id(from_id: str, to_id: str) -> str:
+    ''' vis.js edge id of a link. Made from node ids so it does not change when a node is renamed '''
+    return f'{from_id}:{to_id}'
+
+
+def link_data(from_node: Node, to_node: Node, link: Link) -> Dict:
+    ''' The vis.js data of a link. populate_network adds the same data through pyvis '''
+    return { 'title': link.msg, 'id': link_data_id(from_node.id, to_node.id), 'from': from_node.name, 'to': to_node.name }
+
+
+def generate_data(graph: NetworkGraph) -> Dict:
+    ''' Generate the node and edge data to display the network graph in the page from generate_shell '''
+    nodes = [ node_data(n) for n in graph._nodes.values() ]
+    edges = [ link_data(n, graph.get_node_by_id(e._to), e) for n in graph._nodes.values() for e in n.links ]
+    return { 'nodes': nodes, 'edges': edges }
+
+
+def generate_data_changes(graph: NetworkGraph, changes: List[GraphChange]) -> Dict:
+    ''' Translate a batch of changes into updates of the data from generate_data, for applyGraphChanges in the page.
+        Renames and removals are kept in order, nodes and edges to add or update are taken from the graph as it is now.
+        Returns None if the batch replaced the whole graph.
+    '''
+    operations = list()
+    node_ids = set()
+    link_ids = set()
+    removed_links = list()
+    for c in changes:
+        if c.type == ChangeType.RESET:
+            return None
+        elif c.type in (ChangeType.NODE_ADDED, ChangeType.NODE_EDITED):
+            node_ids.add(c.node_id)
+        elif c.type == ChangeType.NODE_RENAMED:
+            operations.append([ 'rename', c.old_name, c.name ])
+            node_ids.add(c.node_id)
+        elif c.type == ChangeType.NODE_REMOVED:
+            operations.append([ 'remove', c.name ])
+            node_ids.discard(c.node_id)
+        elif c.type in (ChangeType.LINK_ADDED, ChangeType.LINK_EDITED):
+            link_ids.add((c.node_id, c.other_id))
+        elif c.type == ChangeType.LINK_REMOVED:
+            removed_links.append(link_data_id(c.node_id, c.other_id))
+            link_ids.discard((c.node_id, c.other_id))
+
+    nodes = [ node_data(graph._nodes[id]) for id in node_ids if id in graph._nodes ]
+    edges = list()
+    for from_id, to_id in link_ids:
+        from_node = graph._nodes.get(from_id)
+        to_node = graph._nodes.get(to_id)
+        link = from_node.get_link(to_id) if from_node and to_node else None
+        if link:
+            edges.append(link_data(from_node, to_node, link))
+    return { 'operations': operations, 'removeEdges': removed_links, 'nodes': nodes, 'edges': edges }
+
+
+GRAPH_DATA_LOADER = '''
+<script type="text/javascript">
+    function refreshGraphState() {
+        nodeColors = {};
+        allNodes = nodes.get({ returnType: "Object" });
+        for (nodeId in allNodes) {
+            nodeColors[nodeId] = allNodes[nodeId].color;
+        }
+        allEdges = edges.get({ returnType: "Object" });
+
+        var select = document.getElementById("select-node");
+        if (select && select.tomselect) {
+            select.tomselect.clearOptions();
+            select.tomselect.addOptions(nodes.get().map(function(n) { return { value: n.id, text: n.label }; }));
+        }
+    }
+
+    function loadGraphData() {
+        fetch("%s", { cache: "no-cache" }).then(function(response) { return response.json(); }).then(function(data) {
+            nodes.clear();
+            edges.clear();
+            nodes.add(data.nodes);
+            edges.add(data.edges);
+            refreshGraphState();
+        });
+    }
+
+    function renameGraphNode(oldId, newId) {
+        var node = nodes.get(oldId);
+        if (!node) {
+            return;
+        }
+        var connected = edges.get({ filter: function(e) { return e.from == oldId || e.to == oldId; } }).map(function(e) {
+            return { id: e.id, from: e.from == oldId ? newId : e.from, to: e.to == oldId ? newId : e.to };
+        });
+        nodes.remove(oldId);
+        node.id = newId;
+        node.label = newId;
+        nodes.add(node);
+        edges.update(connected);
+    }
+
+    function applyGraphChanges(update) {
+        edges.remove(update.removeEdges);
+        update.operations.forEach(function(op) {
+            if (op[0] == "rename") {
+                renameGraphNode(op[1], op[2]);
+            } else if (op[0] == "remove") {
+                nodes.remove(op[1]);
+            }
+        });
+        nodes.update(update.nodes);
+        edges.update(update.edges);
+        refreshGraphState();
+    }
+
+    loadGraphData();
+</script>
+'''
+
+def generate_shell(data_url: str) -> str:
+    ''' Generate HTML for an empty network which fetches its data from data_url.
+        The HTML does not depend on the graph so it never has to be resent.
+    '''
+    return create_network().generate_html() + GRAPH_DATA_LOADER % data_url
+
+
+
+class GraphPayload():
+    ''' Graph data encoded and compressed once per revision so it can be served with an ETag '''
+    _instance = uuid4().hex[:8] # So ETags from a previous run never match
+
+    def __init__(self, data: Dict, revision: int):
+        self.revision = revision
+        # Each encoding of the body is a different representation so needs its own ETag
+        self.etag = f'"{GraphPayload._instance}-{revision}"'
+        self.gzip_etag = f'"{GraphPayload._instance}-{revision}-gz"'
+        self.body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        self.gzip_body = gzip.compress(self.body)
+
+
+
+class GraphDiff():
+    ''' Changes required to turn a base graph into another graph.
+        Nodes are referred to by name and links by a (from, to) pair of names.
+    '''
+    def __init__(self):
+        self.added_nodes = list()
+        self.removed_nodes = list()
+        self.changed_nodes = list()
+        self.added_links = list()
+        self.removed_links = list()
+        self.changed_links = list()
+
+
+    def __str__(self) -> str:
+        return f"{len(self.added_nodes)} nodes added, {len(self.removed_nodes)} removed, {len(self.changed_nodes)} changed. " + \
+               f"{len(self.added_links)} links added, {len(self.removed_links)} removed, {len(self.changed_links)} changed."
+
+
+
+def _name_index(graph: NetworkGraph) -> Dict[str, Node]:
+    ''' Map of caseless node names to nodes. Node ids differ between files so names are used for matching '''
+    return { name_key(n.name): n for n in graph._nodes.values() }
+
 
-    return generate_custom(net, graph)
+def _link_index(graph: NetworkGraph) -> Dict[Tuple[str, str], Tuple[str, str, Link]]:
+    ''' Map of caseless node name pairs to (from name, to name, link). Links are treated as undirected '''
+    links = dict()
+    for n in graph._nodes.values():
+        for e in n.links:
+            to_node = graph._nodes.get(e._to)
+            if to_node is None:
+                continue
+            key = tuple(sorted((name_key(n.name), name_key(to_node.name))))
+            links[key] = (n.name, to_node.name, e)
+    return links
+
+
+def diff_network_graphs(base: NetworkGraph, other: NetworkGraph) -> GraphDiff:
+    ''' Compare two graphs in linear time, matching nodes by name rather than id '''
+    diff = GraphDiff()
+    base_nodes = _name_index(base)
+    other_nodes = _name_index(other)
+    for key, node in other_nodes.items():
+        base_node = base_nodes.get(key)
+        if base_node is None:
+            diff.added_nodes.append(node.name)
+        elif (base_node.colour, base_node.shape, base_node.notes) != (node.colour, node.shape, node.notes):
+            diff.changed_nodes.append(base_node.name)
+    diff.removed_nodes = [ n.name for key, n in base_nodes.items() if not key in other_nodes ]
+
+    base_links = _link_index(base)
+    other_links = _link_index(other)
+    for key, (from_name, to_name, link) in other_links.items():
+        base_link = base_links.get(key)
+        if base_link is None:
+            diff.added_links.append((from_name, to_name))
+        elif base_link[2].msg != link.msg:
+            diff.changed_links.append(base_link[:2])
+    diff.removed_links = [ l[:2] for key, l in base_links.items() if not key in other_links ]
+    return diff
+
+
+def merge_network_graphs(base: NetworkGraph, other: NetworkGraph) -> List[str]:
+    ''' Merge non-conflicting changes from other into base.
+        Added nodes and links are merged, as are notes and link messages that are empty in base.
+        Removals are never applied. Returns descriptions of the conflicting changes that were skipped.
+    '''
+    diff = diff_network_graphs(base, other)
+    conflicts = list()
+
+    for name in diff.added_nodes:
+        node = other.get_node(name)
+        base.add_node(Node(node.name, colour=node.colour, shape=node.shape, notes=node.notes))
+
+    for name in diff.changed_nodes:
+        node = base.get_node(name)
+        other_node = other.get_node(name)
+        if node.colour != other_node.colour or node.shape != other_node.shape:
+            conflicts.append(f"Node '{name}' style differs")
+        if node.notes != other_node.notes:
+            if not node.notes:
+                base.edit_node(name, node.colour, node.shape, other_node.notes)
+            elif other_node.notes:
+                conflicts.append(f"Node '{name}' notes differ")
+
+    for from_name, to_name in diff.added_links:
+        link = other.get_link(from_name, to_name)
+        base.add_link(from_name, to_name, link.msg)
+
+    for from_name, to_name in diff.changed_links:
+        link = base.get_link(from_name, to_name)
+        other_link = other.get_link(from_name, to_name)
+        if not link.msg:
+            base.edit_link(from_name, to_name, other_link.msg)
+        elif other_link.msg:
+            conflicts.append(f"Link between '{from_name}' and '{to_name}' message differs")
+
+    return conflicts
+
+
+
+DIFF_ADDED_COLOUR = 'Lime'
+DIFF_REMOVED_COLOUR = 'Red'
+DIFF_CHANGED_COLOUR = 'Gold'
+
+def populate_diff_network(net: Network, base: NetworkGraph, other: NetworkGraph, diff: GraphDiff):
+    ''' Add both graphs to a pyvis network as one with the differences highlighted '''
+    added = { name_key(x) for x in diff.added_nodes }
+    removed = { name_key(x) for x in diff.removed_nodes }
+    changed = { name_key(x) for x in diff.changed_nodes }
+
+    nodes = _name_index(other)
+    nodes.update(_name_index(base))
+    for key, n in nodes.items():
+        colour = n.colour
+        if key in added:
+            colour = DIFF_ADDED_COLOUR
+        elif key in removed:
+            colour = DIFF_REMOVED_COLOUR
+        elif key in changed:
+            colour = DIFF_CHANGED_COLOUR
+        net.add_node(n.name, label=n.name, title=f'{n.name}\n{n.notes}', color=colour, shape=n.shape)
+
+    base_links = _link_index(base)
+    other_links = _link_index(other)
+    links = dict(other_links)
+    links.update(base_links)
+    for key, (_, _, link) in links.items():
+        from_name = nodes[key[0]].name
+        to_name = nodes[key[1]].name
+        if not key in base_links:
+            net.add_edge(from_name, to_name, title=link.msg, color=DIFF_ADDED_COLOUR)
+        elif not key in other_links:
+            net.add_edge(from_name, to_name, title=link.msg, color=DIFF_REMOVED_COLOUR, dashes=True)
+        elif link.msg != other_links[key][2].msg:
+            net.add_edge(from_name, to_name, title=f'{link.msg}\n=>\n{other_links[key][2].msg}', color=DIFF_CHANGED_COLOUR)
+        else:
+            net.add_edge(from_name, to_name, title=link.msg)
+
+
+def generate_diff_data(base: NetworkGraph, other: NetworkGraph, diff: GraphDiff=None) -> Dict:
+    ''' Generate the node and edge data to display the highlighted differences in the page from generate_shell '''
+    net = create_network()
+    populate_diff_network(net, base, other, diff or diff_network_graphs(base, other))
+    return network_data(net)
 
 
 
@@ -224,38 +661,582 @@ def load_network_graph_from_json(pjson: str) -> NetworkGraph:
     return jsonpickle.decode(pjson)
 
 
+def validate_network_graph(netgraph: NetworkGraph, repair: bool=False) -> List[str]:
+    ''' Check a loaded graph for problems such as dangling links, duplicate names and invalid colours or shapes.
+        Returns a description of each problem found. When repair is set the problems are fixed in place.
+    '''
+    if not isinstance(netgraph, NetworkGraph) or not isinstance(getattr(netgraph, '_nodes', None), dict):
+        raise NetGraphException("Not a network graph")
+    problems = list()
+    colours = { c.casefold(): c for c in COLOURS }
+    shapes = { s.casefold(): s for s in SHAPES }
+    nodes = dict()
+    names = set()
+
+    for key, node in netgraph._nodes.items():
+        if not isinstance(node, Node):
+            problems.append(f"Entry is not a node: {key}")
+            continue
+        # Fields can be missing from files written by hand or by older versions
+        node_id = getattr(node, 'id', None)
+        name = getattr(node, 'name', None)
+        if not isinstance(name, str) or not name.strip():
+            problems.append(f"Node {node_id} has no name")
+            name = "Unnamed"
+            if repair:
+                node.name = name
+        if name_key(name) in names:
+            problems.append(f"Duplicate node name: {name}")
+            if repair:
+                i = 2
+                while name_key(f"{name} ({i})") in names:
+                    i += 1
+                node.name = name = f"{name} ({i})"
+        names.add(name_key(name))
+
+        if not isinstance(node_id, str) or not node_id or node_id != key or node_id in nodes:
+            problems.append(f"Node '{name}' has id {node_id!r} but is stored under {key!r}")
+            if repair and (not isinstance(node_id, str) or not node_id or node_id in nodes):
+                node.id = node_id = str(uuid4())
+        colour = getattr(node, 'colour', None)
+        if colour not in COLOURS:
+            problems.append(f"Node '{name}' has invalid colour: {colour}")
+            if repair:
+                node.colour = colours.get(str(colour).casefold(), COLOURS[0])
+        shape = getattr(node, 'shape', None)
+        if shape not in SHAPES:
+            problems.append(f"Node '{name}' has invalid shape: {shape}")
+            if repair:
+                node.shape = shapes.get(str(shape).casefold(), SHAPES[0])
+        if not isinstance(getattr(node, 'notes', None), str):
+            problems.append(f"Node '{name}' has invalid notes")
+            if repair:
+                node.notes = ""
+        if not isinstance(getattr(node, 'links', None), list):
+            problems.append(f"Node '{name}' has invalid links")
+            if repair:
+                node.links = list()
+        nodes[node_id if repair else key] = node
+
+    links = set()
+    for node_id, node in nodes.items():
+        node_links = getattr(node, 'links', None)
+        if not isinstance(node_links, list):
+            continue
+        name = getattr(node, 'name', None)
+        valid = list()
+        for link in node_links:
+            to = getattr(link, '_to', link)
+            if not isinstance(link, Link) or not isinstance(to, str) or not to in nodes:
+                problems.append(f"Node '{name}' has a link to a missing node: {to}")
+                continue
+            if _link_key(node_id, to) in links:
+                problems.append(f"Duplicate link between '{name}' and '{getattr(nodes[to], 'name', None)}'")
+                continue
+            if not isinstance(getattr(link, 'msg', None), str):
+                problems.append(f"Link between '{name}' and '{getattr(nodes[to], 'name', None)}' has an invalid message")
+                if repair:
+                    link.msg = ""
+            links.add(_link_key(node_id, to))
+            valid.append(link)
+        if repair:
+            node.links = valid
+
+    names_map = { getattr(n, 'name', None): i for i, n in nodes.items() }
+    if getattr(netgraph, '_names_map', None) != names_map:
+        problems.append("Node names map is out of date")
+    if repair:
+        netgraph._nodes = nodes
+        netgraph._names_map = names_map
+    return problems
+
+
+def load_repaired_network_graph(path: str) -> Tuple[NetworkGraph, List[str]]:
+    ''' Load a graph file and repair any problems in it. Returns the graph and the problems that were repaired.
+        Any failure to read the file is raised as a NetGraphException.
+    '''
+    try:
+        netgraph = load_network_graph(path)
+        return netgraph, validate_network_graph(netgraph, repair=True)
+    except NetGraphException:
+        raise
+    except Exception as e:
+        # jsonpickle can fail with almost any error on a corrupt file
+        raise NetGraphException(f"Could not read file: {path}: {type(e).__name__}: {e}") from e
+
+
+def network_graph_to_snapshot(netgraph: NetworkGraph) -> bytes:
+    ''' Compact compressed representation of the graph. Much faster to encode/decode than jsonpickle '''
+    nodes = [ [n.id, n.name, n.colour, n.shape, n.notes, [ [l._to, l.msg] for l in n.links ]]
+              for n in netgraph._nodes.values() ]
+    return zlib.compress(json.dumps(nodes, separators=(',', ':')).encode('utf-8'))
+
+
+def network_graph_from_snapshot(data: bytes) -> NetworkGraph:
+    nodes = list()
+    for id, name, colour, shape, notes, links in json.loads(zlib.decompress(data)):
+        node = Node(name, colour=colour, shape=shape, notes=notes)
+        node.id = id
+        node.links = [ Link(_to, msg) for _to, msg in links ]
+        nodes.append(node)
+    return NetworkGraph(nodes)
+
+
+
+def _tokenize(text: str) -> Set[str]:
+    return set(re.findall(r'\w+', text.casefold()))
+
+
+def _link_key(a_id: str, b_id: str) -> Tuple[str, str]:
+    ''' Links are undirected when searching so key them by their sorted node ids '''
+    return (a_id, b_id) if a_id <= b_id else (b_id, a_id)
+
+
+
+class TextIndex():
+    ''' Inverted index over node notes and link messages.
+        Kept up to date incrementally by calling the index/remove functions after each graph change.
+    '''
+    def __init__(self):
+        self._node_postings = dict()   # token -> set of node ids
+        self._link_postings = dict()   # token -> set of link keys
+        self._node_tokens = dict()     # node id -> tokens
+        self._link_tokens = dict()     # link key -> tokens
+        self._node_links = dict()      # node id -> set of link keys
+
+
+    def rebuild(self, graph: NetworkGraph):
+        for d in (self._node_postings, self._link_postings, self._node_tokens, self._link_tokens, self._node_links):
+            d.clear()
+        for n in graph._nodes.values():
+            self.index_node(n)
+            for e in n.links:
+                self.index_link(n.id, e._to, e.msg)
+
+
+    def index_node(self, node: Node):
+        ''' Add or update the notes of a node '''
+        self.__remove_tokens(self._node_postings, self._node_tokens, node.id)
+        self.__add_tokens(self._node_postings, self._node_tokens, node.id, node.notes)
+
+
+    def index_link(self, a_id: str, b_id: str, msg: str):
+        ''' Add or update the message of the link between two nodes '''
+        key = _link_key(a_id, b_id)
+        self.__remove_tokens(self._link_postings, self._link_tokens, key)
+        self.__add_tokens(self._link_postings, self._link_tokens, key, msg)
+        self._node_links.setdefault(a_id, set()).add(key)
+        self._node_links.setdefault(b_id, set()).add(key)
+
+
+    def remove_link(self, a_id: str, b_id: str):
+        key = _link_key(a_id, b_id)
+        self.__remove_tokens(self._link_postings, self._link_tokens, key)
+        for id in key:
+            if id in self._node_links:
+                self._node_links[id].discard(key)
+
+
+    def remove_node(self, node_id: str):
+        ''' Remove a node and every link connected to it '''
+        self.__remove_tokens(self._node_postings, self._node_tokens, node_id)
+        for key in list(self._node_links.get(node_id, ())):
+            self.remove_link(*key)
+        self._node_links.pop(node_id, None)
+
+
+    def apply_changes(self, graph: NetworkGraph, changes: List[GraphChange]):
+        ''' Update the index from a list of changes. Can be passed to NetworkGraph.subscribe with the graph bound '''
+        for c in changes:
+            if c.type == ChangeType.RESET:
+                self.rebuild(graph)
+            elif c.type in (ChangeType.NODE_ADDED, ChangeType.NODE_EDITED):
+                if c.node_id in graph._nodes: # Skip nodes removed later in the same batch
+                    self.index_node(graph._nodes[c.node_id])
+            elif c.type == ChangeType.NODE_REMOVED:
+                self.remove_node(c.node_id)
+            elif c.type in (ChangeType.LINK_ADDED, ChangeType.LINK_EDITED):
+                link = graph._nodes[c.node_id].get_link(c.other_id) if c.node_id in graph._nodes else None
+                if link:
+                    self.index_link(c.node_id, c.other_id, link.msg)
+            elif c.type == ChangeType.LINK_REMOVED:
+                self.remove_link(c.node_id, c.other_id)
+
+
+    def search(self, query: str) -> Tuple[Set[str], Set[Tuple[str, str]]]:
+        ''' Find node ids and link keys (pairs of node ids) containing every word in the query '''
+        tokens = _tokenize(query)
+        if not tokens:
+            return set(), set()
+        return self.__search(self._node_postings, tokens), self.__search(self._link_postings, tokens)
+
+
+    @staticmethod
+    def __search(postings: Dict, tokens: Set[str]) -> Set:
+        matches = sorted((postings.get(t, set()) for t in tokens), key=len)
+        return set.intersection(*matches) if matches[0] else set()
+
+
+    @staticmethod
+    def __add_tokens(postings: Dict, forward: Dict, key, text: str):
+        tokens = _tokenize(text)
+        if tokens:
+            forward[key] = tokens
+        for t in tokens:
+            postings.setdefault(t, set()).add(key)
+
+
+    @staticmethod
+    def __remove_tokens(postings: Dict, forward: Dict, key):
+        for t in forward.pop(key, ()):
+            keys = postings[t]
+            keys.discard(key)
+            if not keys:
+                postings.pop(t)
+
+
+
+class _SpillStack():
+    ''' Stack of bytes stored in an append-only file, so records can be popped from the end.
+        The file starts with a tag identifying the save file the records belong to. Each record is framed by its
+        length and checksum before the data and its length after it, so a record torn by a crash can be found and dropped.
+        Only the newest records are cached in memory. Without a path the stack is kept in memory and the oldest entries are dropped.
+    '''
+    MAGIC = b'EXPHIST1'
+    TAG_SIZE = 32
+    HEADER_SIZE = len(MAGIC) + TAG_SIZE
+    RECORD_HEAD = struct.Struct('<II') # Length, crc32
+    RECORD_TAIL = struct.Struct('<I')  # Length
+    RECORD_OVERHEAD = RECORD_HEAD.size + RECORD_TAIL.size
+
+    def __init__(self, path: str=None, memory_limit: int=20, max_entries: int=200, tag: bytes=bytes(TAG_SIZE)):
+        self.path = path
+        self.tag = tag
+        self.memory_limit = max(1, memory_limit)
+        self.max_entries = max(1, max_entries)
+        self._memory = list()  # Newest entries. With a path these mirror the last records in the file
+        self._offsets = list() # Start of each record in the file, oldest first
+        self._end = self.HEADER_SIZE
+        if path and os.path.exists(path):
+            self.__load_offsets()
+
+
+    def __len__(self) -> int:
+        return len(self._offsets) if self.path else len(self._memory)
+
+
+    def push(self, data: bytes):
+        self._memory.append(data)
+        if not self.path:
+            if len(self._memory) > self.max_entries:
+                self._memory.pop(0)
+            return
+
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(self.MAGIC + self.tag)
+            f.write(self.RECORD_HEAD.pack(len(data), zlib.crc32(data)))
+            f.write(data)
+            f.write(self.RECORD_TAIL.pack(len(data)))
+        self._offsets.append(self._end)
+        self._end += len(data) + self.RECORD_OVERHEAD
+
+        # Drop the oldest records once the file grows a quarter past the limit
+        if len(self._offsets) >= self.max_entries + max(1, self.max_entries // 4):
+            self.__compact(len(self._offsets) - self.max_entries)
+        if len(self._memory) > min(self.memory_limit, len(self._offsets)):
+            self._memory.pop(0)
+
+
+    def pop(self) -> bytes:
+        if not self.path:
+            return self._memory.pop() if self._memory else None
+        if not self._offsets:
+            return None
+
+        start = self._offsets.pop()
+        with open(self.path, 'r+b') as f:
+            if self._memory:
+                data = self._memory.pop()
+            else:
+                f.seek(start + self.RECORD_HEAD.size)
+                data = f.read(self._end - start - self.RECORD_OVERHEAD)
+            f.truncate(start)
+        self._end = start
+        return data
+
+
+    def clear(self):
+        self._memory.clear()
+        self._offsets.clear()
+        self._end = self.HEADER_SIZE
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+    def release(self):
+        ''' Drop the in memory cache. Entries remain in the file '''
+        if self.path:
+            self._memory.clear()
+
+
+    def set_tag(self, tag: bytes):
+        ''' Record that the entries belong to a new revision of the save file '''
+        self.tag = tag
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r+b') as f:
+                f.seek(len(self.MAGIC))
+                f.write(tag)
+
+
+    def __compact(self, drop: int):
+        start = self._offsets[drop]
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC + self.tag)
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        shift = start - self.HEADER_SIZE
+        self._offsets = [ x - shift for x in self._offsets[drop:] ]
+        self._end -= shift
+
+
+    def __load_offsets(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            if f.read(self.HEADER_SIZE) != self.MAGIC + self.tag:
+                print(f"Discarding history that does not match its save file: {self.path}")
+                f.close()
+                os.remove(self.path)
+                return
+
+            offsets = list()
+            pos = self.HEADER_SIZE
+            while pos + self.RECORD_OVERHEAD <= size:
+                length, crc = self.RECORD_HEAD.unpack(f.read(self.RECORD_HEAD.size))
+                if pos + length + self.RECORD_OVERHEAD > size:
+                    break
+                data = f.read(length)
+                tail, = self.RECORD_TAIL.unpack(f.read(self.RECORD_TAIL.size))
+                if length == 0 or tail != length or zlib.crc32(data) != crc:
+                    break
+                offsets.append(pos)
+                pos += length + self.RECORD_OVERHEAD
+
+        if pos != size:
+            print(f"Dropping torn record from history file: {self.path}")
+            os.truncate(self.path, pos)
+        self._offsets = offsets
+        self._end = pos
+
+
+
+def file_digest(path: str) -> bytes:
+    ''' sha256 of a file's contents. A missing file has the digest of empty contents '''
+    digest = hashlib.sha256()
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.digest()
+
+
 
 class UndoHistory():
-    def __init__(self):
-        self.undos = list()
-        self.redos = list()
+    ''' Undo and redo stacks of compressed graph snapshots.
+        When given a path the history is written to files next to it so it survives restarts,
+        with only the most recent snapshots cached in memory.
+        The files are tagged with the digest of the save file and discarded if it has changed since,
+        so call saved() after every save.
+        Each stack keeps up to 1.25 x max_entries snapshots on disk before compacting, so the worst case
+        disk use is 2.5 x max_entries x the compressed snapshot size. A graph of 1000 nodes and 1000 links
+        snapshots to about 45KB, so about 22MB with the default limit.
+    '''
+    def __init__(self, path: str=None, memory_limit: int=20, max_entries: int=200):
+        undo_path = path + '.undo' if path else None
+        redo_path = path + '.redo' if path else None
+        self.path = path
+        tag = file_digest(path) if path else bytes(_SpillStack.TAG_SIZE)
+        self.undos = _SpillStack(undo_path, memory_limit, max_entries, tag)
+        self.redos = _SpillStack(redo_path, memory_limit, max_entries, tag)
 
 
-    def add_undo(self, obj):
-        jp = jsonpickle.encode(obj)
-        self.undos.append(jp)
+    def add_undo(self, obj: NetworkGraph):
+        self.undos.push(network_graph_to_snapshot(obj))
 
 
-    def add_redo(self, obj):
-        jp = jsonpickle.encode(obj)
-        self.redos.append(jp)
+    def add_redo(self, obj: NetworkGraph):
+        self.redos.push(network_graph_to_snapshot(obj))
 
 
-    def undo(self, obj):
+    def undo(self, obj: NetworkGraph) -> NetworkGraph:
         if self.undos:
             self.add_redo(obj)
-            jp = self.undos.pop(-1)
-            return jsonpickle.decode(jp)
+            return network_graph_from_snapshot(self.undos.pop())
         return None
 
 
-    def redo(self, obj):
+    def redo(self, obj: NetworkGraph) -> NetworkGraph:
         if self.redos:
             self.add_undo(obj)
-            jp = self.redos.pop(-1)
-            return jsonpickle.decode(jp)
+            return network_graph_from_snapshot(self.redos.pop())
         return None
 
 
     def clear_redos(self):
-        self.redos.clear()
\ No newline at end of file
+        self.redos.clear()
+
+
+    def saved(self):
+        ''' Tie the history to the current contents of the save file '''
+        if self.path:
+            tag = file_digest(self.path)
+            self.undos.set_tag(tag)
+            self.redos.set_tag(tag)
+
+
+    def release(self):
+        ''' Free the snapshots held in memory. Only has an effect when the history is stored on disk '''
+        self.undos.release()
+        self.redos.release()
+
+
+
+NODE_MEMORY_OVERHEAD = 1000 # Rough bytes used by a node object, its id and map entries
+LINK_MEMORY_OVERHEAD = 300
+
+def estimate_graph_size(netgraph: NetworkGraph) -> int:
+    ''' Rough number of bytes of memory used by a loaded graph '''
+    size = 0
+    for n in netgraph._nodes.values():
+        size += NODE_MEMORY_OVERHEAD + len(n.name) + len(n.notes)
+        for e in n.links:
+            size += LINK_MEMORY_OVERHEAD + len(e.msg)
+    return size
+
+
+
+class GraphDocument():
+    ''' A network graph bound to a save file along with its own undo history.
+        The graph may be evicted to a snapshot file in cache_dir and is reloaded lazily when requested.
+    '''
+    def __init__(self, path: str, cache_dir: str):
+        self.path = path
+        self.history = UndoHistory(path)
+        self.size = 0 # Estimated memory used by the graph when loaded
+        self.problems = list() # Problems repaired when the file was loaded
+        self._netgraph = None
+        self._snapshot_path = os.path.join(cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.snapshot')
+
+
+    def is_loaded(self) -> bool:
+        return self._netgraph is not None
+
+
+    def get_graph(self) -> NetworkGraph:
+        if self._netgraph is None:
+            if os.path.exists(self._snapshot_path):
+                with open(self._snapshot_path, 'rb') as f:
+                    self._netgraph = network_graph_from_snapshot(f.read())
+                os.remove(self._snapshot_path)
+            elif os.path.exists(self.path):
+                self._netgraph, self.problems = load_repaired_network_graph(self.path)
+                for problem in self.problems:
+                    print(f"Repaired problem in '{self.path}': {problem}")
+            else:
+                self._netgraph = NetworkGraph()
+            self.size = estimate_graph_size(self._netgraph)
+        return self._netgraph
+
+
+    def evict(self):
+        ''' Drop the graph from memory, writing a compressed snapshot to disk for a fast reload '''
+        if self._netgraph is not None:
+            print(f"Evicting netgraph from memory: {self.path}")
+            with open(self._snapshot_path, 'wb') as f:
+                f.write(network_graph_to_snapshot(self._netgraph))
+            self._netgraph = None
+            self.history.release()
+
+
+    def discard(self):
+        ''' Free everything held for this document. The save file and its history are left untouched '''
+        self._netgraph = None
+        self.history.release()
+        if os.path.exists(self._snapshot_path):
+            os.remove(self._snapshot_path)
+
+
+
+class DocumentManager():
+    ''' Keeps track of open documents. Only the most recently used documents stay loaded in memory,
+        limited by both a count and an estimated memory budget. The active document is never evicted.
+    '''
+    def __init__(self, max_loaded: int=3, memory_budget: int=64 * 1024 * 1024):
+        self.max_loaded = max(1, max_loaded)
+        self.memory_budget = memory_budget
+        self._documents = OrderedDict() # path -> GraphDocument, least recently used first
+        self._cache_dir = None
+
+
+    def get_document_paths(self) -> List[str]:
+        return list(self._documents.keys())
+
+
+    def contains_document(self, path: str) -> bool:
+        return path in self._documents
+
+
+    def get_active(self) -> GraphDocument:
+        ''' Most recently activated document. None if there are no open documents '''
+        if not self._documents:
+            return None
+        return next(reversed(self._documents.values()))
+
+
+    def open(self, path: str) -> GraphDocument:
+        ''' Open the document at path (if not already open) and make it the active document '''
+        if not path in self._documents:
+            if self._cache_dir is None:
+                self._cache_dir = tempfile.mkdtemp(prefix='expnetvis-')
+            self._documents[path] = GraphDocument(path, self._cache_dir)
+        return self.activate(path)
+
+
+    def activate(self, path: str) -> GraphDocument:
+        if not path in self._documents:
+            raise NetGraphException("Document is not open: " + path)
+        self._documents.move_to_end(path)
+        document = self._documents[path]
+        document.size = estimate_graph_size(document.get_graph()) # May have grown while active
+        self.__evict_inactive()
+        return document
+
+
+    def close(self, path: str):
+        if path in self._documents:
+            self._documents.pop(path).discard()
+
+
+    def cleanup(self):
+        ''' Close every document and remove the snapshot directory '''
+        for document in self._documents.values():
+            document.discard()
+        self._documents.clear()
+        if self._cache_dir:
+            shutil.rmtree(self._cache_dir, ignore_errors=True)
+            self._cache_dir = None
+
+
+    def __evict_inactive(self):
+        loaded = [ d for d in self._documents.values() if d.is_loaded() ]
+        total = sum(d.size for d in loaded)
+        for document in loaded[:-1]: # Least recently used first, never the active document
+            if len(loaded) <= self.max_loaded and total <= self.memory_budget:
+                break
+            document.evict()
+            loaded.remove(document)
+            total -= document.size
\ No newline at end of file
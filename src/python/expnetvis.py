@@ -4,9 +4,11 @@ __license__ = "MIT License"
 __version__ = "0.3"
 
 import os
+import json
 from typing import List, Dict
 from argparse import ArgumentParser
-from nicegui import app, ui
+from fastapi import Request, Response
+from nicegui import app, ui, background_tasks
 import nicegui.globals as niceglobals
 from nicegui.events import KeyEventArguments
 import expnetgraph
@@ -16,6 +18,7 @@ COLOURS = expnetgraph.COLOURS
 SHAPES = expnetgraph.SHAPES
 
 DEFAULT_FIELD_STYLE = 'width: 500px;'
+GRAPH_DATA_URL = '/graph/data'
 
 save_file = None
 
@@ -27,6 +30,50 @@ node_names.extend(netgraph.get_all_node_names())
 
 history = expnetgraph.UndoHistory()
 
+documents = expnetgraph.DocumentManager()
+document_select = None
+file_dialog = None
+file_dialog_close_button = None
+
+autocomplete_inputs = [] # Inputs that autocomplete node_names
+
+text_index = expnetgraph.TextIndex()
+
+graph_payload = expnetgraph.GraphPayload(expnetgraph.generate_data(netgraph), 0)
+graph_payload_stale = False # Set when clients were updated with changes instead of new graph data
+diff_shown = False
+
+
+def graph_changed(changes: List[expnetgraph.GraphChange]):
+    ''' Subscriber to the working netgraph. Keeps the autocomplete values, search index and rendered graph up to date '''
+    global graph_payload_stale
+    text_index.apply_changes(netgraph, changes)
+    names_changed = False
+    for c in changes:
+        if c.type == expnetgraph.ChangeType.RESET:
+            node_names.clear()
+            node_names.extend(netgraph.get_all_node_names())
+        elif c.type == expnetgraph.ChangeType.NODE_ADDED:
+            node_names.append(c.name)
+        elif c.type == expnetgraph.ChangeType.NODE_REMOVED:
+            node_names.remove(c.name)
+        elif c.type == expnetgraph.ChangeType.NODE_RENAMED:
+            node_names[node_names.index(c.old_name)] = c.name
+        else:
+            continue
+        names_changed = True
+    if names_changed:
+        for comp in autocomplete_inputs:
+            comp.update()
+
+    # A reset is drawn by redraw_graph and a diff is replaced by the graph after a modification
+    update = None if diff_shown else expnetgraph.generate_data_changes(netgraph, changes)
+    if update is not None:
+        graph_payload_stale = True
+        run_client_javascript(f'applyGraphChanges({json.dumps(update)})')
+
+netgraph.subscribe(graph_changed)
+
 
 def clear_comp_values(*args):
     ''' Return nicegui components to default blank values '''
@@ -41,10 +88,12 @@ def netgraph_modification(func):
     def inner(*args, **kwargs):
         try:
             history.add_undo(netgraph)
-            func(*args, **kwargs)
+            with netgraph.batch():
+                func(*args, **kwargs)
             history.clear_redos()
             save_netgraph()
-            redraw_graph()
+            if diff_shown:
+                redraw_graph()
         except expnetgraph.NetGraphException as e:
             ui.notify(e.msg, type='negative')
             raise e
@@ -71,32 +120,149 @@ def save_netgraph():
     global save_file
     if save_file:
         expnetgraph.save_network_graph(save_file, netgraph)
+        history.saved()
 
 
-def load_netgraph():
+def set_working_graph(graph: expnetgraph.NetworkGraph, graph_history: expnetgraph.UndoHistory, path: str):
+    ''' Replace the netgraph that the UI works on and render it '''
     global netgraph
+    global history
     global save_file
-    if save_file:
-        netgraph = expnetgraph.load_network_graph(save_file)
-    else:
-        netgraph = expnetgraph.NetworkGraph()
+    netgraph.unsubscribe(graph_changed)
+    netgraph = graph
+    netgraph.subscribe(graph_changed)
+    history = graph_history
+    save_file = path
+    graph_changed([expnetgraph.GraphChange(expnetgraph.ChangeType.RESET)])
+    update_elements()
     redraw_graph()
 
 
+def activate_document(path: str):
+    ''' Make an open document the working netgraph and render it '''
+    document = documents.activate(path)
+    if document.problems:
+        ui.notify(f"Repaired {len(document.problems)} problems in {os.path.basename(path)}", type='warning')
+        document.problems = list()
+    set_working_graph(document.get_graph(), document.history, document.path)
+
+
+def close_document():
+    ''' Close the working document and switch to the most recently used one left open '''
+    if not save_file or not documents.contains_document(save_file):
+        return
+    print(f"Closing document: {save_file}")
+    documents.close(save_file)
+    active = documents.get_active()
+    if active:
+        activate_document(active.path)
+    else:
+        set_working_graph(expnetgraph.NetworkGraph(), expnetgraph.UndoHistory(), None)
+        file_selection_dialog()
+
+
 def update_elements():
-    ''' Update UI elements so they reflect current changes such as autocomplete values '''
-    node_names.clear()
-    node_names.extend(netgraph.get_all_node_names())
-    ui.update()
+    ''' Update the document selector so it reflects the open documents '''
+    if document_select:
+        document_select.options = { p: os.path.basename(p) for p in documents.get_document_paths() }
+        document_select.update()
+        if document_select.value != save_file:
+            document_select.value = save_file
+
+
+def run_client_javascript(code: str):
+    ''' Run javascript in the page without waiting for it. Pages that are not connected yet fetch the graph data when they load '''
+    client = niceglobals.get_client()
+    if client.has_socket_connection:
+        background_tasks.create(client.run_javascript(code, respond=False))
 
 
 def redraw_graph():
-    ''' Rerender and graph HTML and force the client to refresh the page '''
-    niceglobals.get_client().body_html = "" # Remove existing HTML
-    html = expnetgraph.generate(netgraph)
-    ui.add_body_html(html)
-    update_elements()
-    ui.open('/')
+    ''' Regenerate the graph data and have connected clients fetch it '''
+    global diff_shown
+    diff_shown = False
+    show_graph_data(expnetgraph.generate_data(netgraph))
+
+
+def show_graph_data(data: Dict):
+    ''' Serve new data from the graph data endpoint and have connected clients fetch it '''
+    global graph_payload
+    global graph_payload_stale
+    graph_payload = expnetgraph.GraphPayload(data, graph_payload.revision + 1)
+    graph_payload_stale = False
+    run_client_javascript('loadGraphData()')
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    ''' Weak comparison of an ETag against an If-None-Match list '''
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    ''' Whether an Accept-Encoding header allows the encoding. An encoding given q=0 is refused '''
+    qualities = dict()
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+
+async def graph_data_endpoint(request: Request) -> Response:
+    ''' Serve the current graph data. Clients revalidate using the ETag so unchanged data is not sent again.
+        Async so it runs on the event loop with the UI handlers, which change the graph and payload without locking.
+    '''
+    global graph_payload
+    global graph_payload_stale
+    if graph_payload_stale:
+        graph_payload = expnetgraph.GraphPayload(expnetgraph.generate_data(netgraph), graph_payload.revision + 1)
+        graph_payload_stale = False
+    payload = graph_payload
+    use_gzip = accepts_encoding(request.headers.get('accept-encoding', ''), 'gzip')
+    etag = payload.gzip_etag if use_gzip else payload.etag
+    headers = { 'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding' }
+    if etag_matches(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(payload.gzip_body, media_type='application/json', headers=headers)
+    return Response(payload.body, media_type='application/json', headers=headers)
+
+
+def load_other_file(path: str) -> expnetgraph.NetworkGraph:
+    ''' Load another graph file for comparison '''
+    if not path or not os.path.isfile(path):
+        raise expnetgraph.NetGraphException(f"File does not exist: {path}")
+    other, _ = expnetgraph.load_repaired_network_graph(path)
+    return other
+
+
+def show_diff(path: str):
+    ''' Render the working graph overlaid with the differences to another file '''
+    global diff_shown
+    try:
+        other = load_other_file(path)
+    except expnetgraph.NetGraphException as e:
+        ui.notify(e.msg, type='negative')
+        return
+    diff = expnetgraph.diff_network_graphs(netgraph, other)
+    print(f"Diff with '{path}': {diff}")
+    diff_shown = True
+    show_graph_data(expnetgraph.generate_diff_data(netgraph, other, diff))
+    ui.notify(str(diff))
 
 
 @netgraph_modification
@@ -120,10 +286,7 @@ def rename_node(old_name, new_name):
 @netgraph_modification
 def edit_node(name, colour, shape, notes):
     print(f"Editing node: '{name}' to colour {colour} and shape {shape} with notes: {notes}")
-    node = netgraph.get_node(name)
-    node.colour = colour
-    node.shape = shape
-    node.notes = notes
+    netgraph.edit_node(name, colour, shape, notes)
 
 
 @netgraph_modification
@@ -150,8 +313,31 @@ def remove_link(nodeA: str, nodeB: str):
     netgraph.remove_link(nodeA, nodeB)
 
 
+def merge_file(path: str):
+    ''' Merge another file into the working graph. The file is read first so a bad file leaves no undo entry '''
+    print(f"Merging changes from '{path}'")
+    try:
+        other = load_other_file(path)
+    except expnetgraph.NetGraphException as e:
+        ui.notify(e.msg, type='negative')
+        return
+    merge_graph(other)
+
+
+@netgraph_modification
+def merge_graph(other: expnetgraph.NetworkGraph):
+    conflicts = expnetgraph.merge_network_graphs(netgraph, other)
+    for conflict in conflicts:
+        print(f"Merge conflict: {conflict}")
+    if conflicts:
+        ui.notify(f"{len(conflicts)} conflicting changes were not merged", type='warning')
+
+
 def create_input(*args, **kwargs):
-    return ui.input(*args, **kwargs).style(DEFAULT_FIELD_STYLE)
+    comp = ui.input(*args, **kwargs).style(DEFAULT_FIELD_STYLE)
+    if kwargs.get('autocomplete') is node_names:
+        autocomplete_inputs.append(comp)
+    return comp
 
 def create_dropdown(*args, **kwargs):
     return ui.select(*args, **kwargs).style(DEFAULT_FIELD_STYLE)
@@ -192,6 +378,22 @@ async def clear_selection():
     await ui.run_javascript('neighbourhoodHighlight({ nodes: [] });', respond=False)
 
 
+async def highlight_search(query: str):
+    ''' Select the nodes and links whose notes or messages match the query '''
+    node_ids, link_keys = text_index.search(query)
+    names = [ netgraph.get_node_by_id(id).name for id in node_ids ]
+    pairs = [ [ netgraph.get_node_by_id(a).name, netgraph.get_node_by_id(b).name ] for a, b in link_keys ]
+    if not names and not pairs:
+        ui.notify(f"No matches for: {query}")
+    await ui.run_javascript(f'''
+        var pairs = {json.dumps(pairs)};
+        var edgeIds = edges.getIds({{ filter: function(e) {{
+            return pairs.some(function(p) {{ return (e.from == p[0] && e.to == p[1]) || (e.from == p[1] && e.to == p[0]); }});
+        }} }});
+        network.setSelection({{ nodes: {json.dumps(names)}, edges: edgeIds }}, {{ highlightEdges: false }});
+        ''', respond=False)
+
+
 async def get_node_positions() -> Dict:
     ''' NOT USED. Fetch a map of x, y coordinates for every node '''
     node_names = [ f'"{x}"' for x in netgraph.get_all_node_names() ]
@@ -420,6 +622,61 @@ def create_buttons_row():
 
         ui.button('Reset Selection', on_click=clear_selection)
 
+
+        # Search Button
+        with ui.dialog() as search_dialog, ui.card():
+            ui.markdown("Search Notes and Links")
+            search_input = create_input(label="Search text")
+
+            with ui.row():
+                async def search_clicked():
+                    if not search_input.value:
+                        return
+                    search_dialog.close()
+                    await highlight_search(search_input.value)
+                ui.button('Search', on_click=search_clicked)
+                ui.button('Close', on_click=search_dialog.close)
+        ui.button('Search', on_click=search_dialog.open)
+
+        ## Add spacer
+        ui.label("| |")
+
+        # Open Documents
+        ui.button('Open File', on_click=lambda: file_selection_dialog(persistent=False))
+        ui.button('Close File', on_click=close_document)
+
+        def document_selected(e):
+            if e.value and e.value != save_file:
+                activate_document(e.value)
+        global document_select
+        document_select = ui.select({}, on_change=document_selected).style('width: 200px;')
+
+
+        # Compare File Button
+        with ui.dialog() as compare_dialog, ui.card():
+            ui.markdown("Compare With File")
+            compare_file_input = create_input(label="Other file")
+
+            with ui.row():
+                def show_diff_clicked():
+                    if not compare_file_input.value:
+                        return
+                    compare_dialog.close()
+                    show_diff(compare_file_input.value)
+                def merge_clicked():
+                    if not compare_file_input.value:
+                        return
+                    compare_dialog.close()
+                    merge_file(compare_file_input.value)
+                def hide_diff_clicked():
+                    compare_dialog.close()
+                    redraw_graph()
+                ui.button('Show Diff', on_click=show_diff_clicked)
+                ui.button('Merge', on_click=merge_clicked)
+                ui.button('Hide Diff', on_click=hide_diff_clicked)
+                ui.button('Close', on_click=compare_dialog.close)
+        ui.button('Compare File', on_click=compare_dialog.open)
+
 #         ## Add spacer
 #         ui.label("| |")
 
@@ -456,19 +713,23 @@ def init_keybinds():
 
 
 def load_from_file(abspath):
-    ''' Load data from file and render the netgraph '''
-    global save_file
-    save_file = os.path.abspath(abspath)
-    print(f"Loading from file: {save_file}")
-    if os.path.exists(save_file):
-        load_netgraph()
-    else:
-        redraw_graph()
+    ''' Open the file as a document and render the netgraph. Files that are already open are switched to '''
+    path = os.path.abspath(abspath)
+    print(f"Loading from file: {path}")
+    try:
+        documents.open(path)
+    except expnetgraph.NetGraphException as e:
+        documents.close(path)
+        ui.notify(e.msg, type='negative')
+        return
+    activate_document(path)
     
 
 
-def file_selection_dialog():
-    ''' Show the 'Create New'/'Open Existing' dialog and load the graph using that chosen file selection '''
+def create_file_selection_dialog():
+    ''' Create the 'Create New'/'Open Existing' dialog which loads the graph using the chosen file selection '''
+    global file_dialog
+    global file_dialog_close_button
     with ui.dialog() as dialog, ui.card():
         ui.markdown("Choose working file...")
 
@@ -493,9 +754,18 @@ def file_selection_dialog():
 
         ui.button('Open Existing', on_click=open_file)
         ui.button('Create New', on_click=new_file)
-    
-    dialog.props('persistent') # So this dialog cannot be dismissed normally
-    dialog.open()
+        file_dialog_close_button = ui.button('Close', on_click=dialog.close)
+    file_dialog = dialog
+
+
+def file_selection_dialog(persistent: bool=True):
+    ''' Show the file selection dialog. A persistent dialog cannot be dismissed until a file is chosen '''
+    if persistent:
+        file_dialog.props('persistent')
+    else:
+        file_dialog.props(remove='persistent')
+    file_dialog_close_button.set_visibility(not persistent)
+    file_dialog.open()
 
 
 
@@ -510,9 +780,14 @@ def main():
 
     ## Allow javscript resources for pyvis to be served
     app.add_static_files('/lib', 'lib')
+    ## Graph data is fetched by the page separately so the page itself never changes
+    app.add_api_route(GRAPH_DATA_URL, graph_data_endpoint)
+    ui.add_body_html(expnetgraph.generate_shell(GRAPH_DATA_URL))
 
     create_buttons_row()
+    create_file_selection_dialog()
     init_keybinds()
+    app.on_shutdown(documents.cleanup)
 
     # load graph from file if it exists, otherwise show dialog
     if save_file: